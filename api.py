@@ -30,29 +30,35 @@ Supports the following query parameters:
 All other query parameters are ignored.
 """
 
+import time
+
+# Measures how long a new instance takes to import the application.
+_IMPORT_STARTED = time.time()
+
 import json
 import logging
 import os
+import threading
 import traceback
-import MySQLdb
 import re
+import urllib
 
 import sqlalchemy
 
-# flask, geojson,geomet and sqlparse are external dependencies.
+# flask, geojson and geomet are external dependencies.
 # Install them by running pip install -r requirements.txt -t lib
-import sqlparse
-
 import flask
 
 import geojson
 
-from google.appengine.api import users
-from google.appengine.api import oauth
-
 import jacs.features
 import jacs.auth
 
+# Modules only used by rarely called handlers, like MySQLdb and jacs.export,
+# are imported in those handlers so they don't slow down new instances.
+
+_IMPORT_FINISHED = time.time()
+
 
 CLIENT_SECRETS = os.path.join(os.path.dirname(__file__), 'client_secrets.json')
 
@@ -80,6 +86,18 @@ _SQL_TEST_ENGINE='mysql+mysqldb://%(username)s:%(password)s@%(host)s/%(database)
     'instance': _INSTANCE
     }
 
+# These tables are reflected by the warmup request, so the first requests to
+# a new instance don't have to.
+_WARMUP_TABLES = []
+
+# Exports are written to this Cloud Storage bucket, the default bucket of the
+# application if None. Each chunk is exported by a task on _EXPORT_QUEUE,
+# which is defined in queue.yaml, and a failing chunk is tried
+# _EXPORT_RETRIES times before the export is stopped.
+_EXPORT_BUCKET = None
+_EXPORT_QUEUE = 'export'
+_EXPORT_RETRIES = 3
+
 _SQL_PROD_ENGINE='mysql+gaerdbms:///%(database)s?instance=%(instance)s' % {
     'database': _MYSQL_DATABASE,
     'instance': _INSTANCE
@@ -89,20 +107,125 @@ _SQL_PROD_ENGINE='mysql+gaerdbms:///%(database)s?instance=%(instance)s' % {
 # the App Engine WSGI application server.
 app = flask.Flask(__name__)
 
+_engine = None
+_features = None
+_engine_lock = threading.Lock()
+_features_lock = threading.Lock()
+
+
+def is_production():
+    return (os.getenv('SERVER_SOFTWARE') and
+            os.getenv('SERVER_SOFTWARE').startswith('Google App Engine/'))
+
+
+def get_engine():
+    """Return the engine of this instance, creating it on first use.
+
+    The engine, and so its connection pool, is shared by all requests.
+    """
+    global _engine
+    if _engine is None:
+        with _engine_lock:
+            if _engine is None:
+                if is_production():
+                    _engine = sqlalchemy.create_engine(
+                            _SQL_PROD_ENGINE, echo=False)
+                else:
+                    _engine = sqlalchemy.create_engine(
+                            _SQL_TEST_ENGINE, echo=True)
+    return _engine
+
+
+def get_features():
+    """Return the Features of this instance, which caches reflected tables."""
+    global _features
+    if _features is None:
+        engine = get_engine()
+        with _features_lock:
+            if _features is None:
+                _features = jacs.features.Features(engine, _GEOMETRY_FIELD)
+    return _features
+
+
+def get_export_storage():
+    """Return the storage for exports.
+
+    On the development server the cloudstorage client stores files locally.
+    """
+    import jacs.export
+    bucket = _EXPORT_BUCKET
+    if bucket is None:
+        from google.appengine.api import app_identity
+        bucket = app_identity.get_default_gcs_bucket_name()
+    return jacs.export.CloudStorage(bucket)
+
+
+def enqueue_export_chunk(table, job):
+    """Add the task that exports the next chunk of job.
+
+    Tasks are named after the chunk, so a chunk is never queued twice.
+    """
+    from google.appengine.api import taskqueue
+    try:
+        taskqueue.add(
+                queue_name=_EXPORT_QUEUE,
+                url='/tables/%s/export/%s/chunk' % (
+                        urllib.quote(table), job.job_id),
+                name='export-%s-%d-%d' % (
+                        job.job_id, job.manifest['runs'],
+                        job.manifest['chunks']))
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        logging.info('Chunk %d of export %s is already queued',
+                     job.manifest['chunks'], job.job_id)
+
 
 @app.before_request
 def before_request():
-    if (os.getenv('SERVER_SOFTWARE') and
-        os.getenv('SERVER_SOFTWARE').startswith('Google App Engine/')):
-        flask.g.engine = sqlalchemy.create_engine(_SQL_PROD_ENGINE, echo=False)
-    else:
-        flask.g.engine = sqlalchemy.create_engine(_SQL_TEST_ENGINE, echo=True)
+    flask.g.engine = get_engine()
 
     try:
-        flask.g.features = jacs.features.Features(flask.g.engine, _GEOMETRY_FIELD)
+        flask.g.features = get_features()
     except sqlalchemy.exc.DBAPIError as e:
         build_response({'error': 'Database Error %s' % str(e), 'status': 500})
 
+@app.route('/_ah/warmup')
+def do_warmup():
+    """Prepare a new instance before it receives requests.
+
+    Connects to the database to fill the pool, reflects _WARMUP_TABLES and
+    runs a query on each of them, which compiles the statement and loads the
+    geometry and GeoJSON converters.
+
+    Returns:
+      A flask.Response object with the time, in seconds, each step took.
+    """
+    timings = {'import': _IMPORT_FINISHED - _IMPORT_STARTED}
+    started = time.time()
+    engine = get_engine()
+    engine.connect().close()
+    timings['engine'] = time.time() - started
+
+    step = time.time()
+    features = get_features()
+    for table in _WARMUP_TABLES:
+        features.initialize_table(table)
+    timings['reflect'] = time.time() - step
+
+    step = time.time()
+    for table in _WARMUP_TABLES:
+        result = features.query(table, '', None, limit=1)
+        if 'error' in result:
+            logging.warning('Warmup query on %s failed: %s', table,
+                            result['error'])
+        else:
+            geojson.dumps(result)
+    timings['prime'] = time.time() - step
+
+    timings['startup'] = time.time() - _IMPORT_STARTED
+    logging.info('Warmup timings: %s', timings)
+    return build_response(timings)
+
+
 @app.route('/tables/<table>/features')
 def do_features_list(table):
     """Handle the parsing of the request and return the geojson.
@@ -162,6 +285,118 @@ def do_feature_delete(table):
     return build_response(result)
 
 
+@app.route('/tables/<table>/export', methods=['POST'])
+def do_export_start(table):
+    """Start, or resume, a background export of the whole table.
+
+    Supports the query parameters format (ndjson or bin), chunkSize and
+    resume, the id of an earlier export of the table to continue.
+
+    Returns:
+      A flask.Response object with the status of the export job.
+    """
+    import jacs.export
+    if not jacs.auth.authorize('export', table):
+        return build_response(
+                jacs.features.error_message('Unauthorized', status=401))
+    storage = get_export_storage()
+    resume = flask.request.args.get('resume')
+    try:
+        if resume:
+            job = jacs.export.ExportJob.load(storage, resume)
+            if job is None or job.manifest['table'] != table:
+                return build_response(jacs.features.error_message(
+                        'No such export', status=404))
+            if job.manifest['state'] in (jacs.export.RUNNING,
+                                         jacs.export.DONE):
+                return build_response(jacs.features.error_message(
+                        'Export is already %s' % job.manifest['state'],
+                        status=409))
+            job.manifest['runs'] += 1
+        else:
+            job = jacs.export.ExportJob.create(
+                    storage, table,
+                    fmt=flask.request.args.get('format', default='ndjson'),
+                    chunk_size=int(flask.request.args.get(
+                            'chunkSize', default=1000)))
+        job.check(flask.g.features)
+    except ValueError as e:
+        return build_response(jacs.features.error_message(str(e)))
+    except sqlalchemy.exc.NoSuchTableError:
+        return build_response(jacs.features.error_message(
+                'No such table', status=404))
+    job.manifest['state'] = jacs.export.RUNNING
+    job.manifest['error'] = None
+    job.save()
+    try:
+        enqueue_export_chunk(table, job)
+    except Exception as e:
+        # Without a task the job would stay running, and could not be resumed.
+        logging.exception('Could not queue export %s', job.job_id)
+        job.fail(e)
+        return build_response(jacs.features.error_message(
+                'Could not start export %s: %s' % (job.job_id, e),
+                status=503))
+    return build_response(job.status())
+
+
+@app.route('/tables/<table>/export/<job_id>/chunk', methods=['POST'])
+def do_export_chunk(table, job_id):
+    """Export the next chunk of an export job, run by the task queue.
+
+    Returns:
+      A flask.Response object with the status of the export job. An error
+      status makes the task queue retry the chunk.
+    """
+    import jacs.export
+    # App Engine removes this header from requests from outside.
+    if 'X-AppEngine-QueueName' not in flask.request.headers:
+        return build_response(
+                jacs.features.error_message('Forbidden', status=403))
+    try:
+        job = jacs.export.ExportJob.load(get_export_storage(), job_id)
+    except ValueError as e:
+        return build_response(jacs.features.error_message(str(e)))
+    if job is None or job.manifest['table'] != table:
+        return build_response(jacs.features.error_message(
+                'No such export', status=404))
+    if job.manifest['state'] != jacs.export.RUNNING:
+        return build_response(job.status())
+
+    try:
+        done = job.run_chunk(flask.g.features)
+    except Exception as e:
+        retries = int(flask.request.headers.get(
+                'X-AppEngine-TaskRetryCount', 0))
+        if retries < _EXPORT_RETRIES:
+            logging.exception('Chunk %d of export %s failed',
+                              job.manifest['chunks'], job_id)
+            return build_response(jacs.features.error_message(
+                    str(e), status=500))
+        job.fail(e)
+        return build_response(job.status())
+    if not done:
+        enqueue_export_chunk(table, job)
+    return build_response(job.status())
+
+
+@app.route('/tables/<table>/export/<job_id>')
+def do_export_status(table, job_id):
+    """Return the progress of an export job of the table."""
+    import jacs.export
+    if not jacs.auth.authorize('export', table):
+        return build_response(
+                jacs.features.error_message('Unauthorized', status=401))
+    try:
+        job = jacs.export.ExportJob.load(get_export_storage(), job_id)
+    except ValueError as e:
+        return build_response(jacs.features.error_message(str(e)))
+    if job is None or job.manifest['table'] != table:
+        return build_response(jacs.features.error_message(
+                'No such export', status=404))
+    return build_response(job.status())
+
+
 def build_response(result, method=json.dumps):
     status = 200
     if 'status' in result:
@@ -192,6 +427,7 @@ def do_pip(database, table):
     lat = float(flask.request.args.get('lat', default=0.0))
     lng = float(flask.request.args.get('lng', default=0.0))
     select = flask.request.args.get('select', default='')
+    import MySQLdb
     try:
         pip = PointInPolygon(_INSTANCE, database, table)
     except MySQLdb.OperationalError as e:
@@ -11,28 +11,219 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+"""Authorization of table actions.
 
-from google.appengine.api import users
-from google.appengine.api import oauth
+Every table has a policy that maps an action ("read", "write", "export") to
+the level required to perform it:
+* anyone: no credentials are needed, no user lookups are made.
+* user: any signed in user, either with a cookie or with OAuth.
+* admin: an application admin signed in with a cookie.
+
+Policies are loaded once from table_policies.json, if it exists, e.g.
+{"airports": {"read": "anyone", "write": "user"}}
+Tables and actions without a policy use _DEFAULT_POLICY. If the file is
+invalid the error is logged and every action that needs a policy is denied,
+rather than falling back to defaults that may be more permissive.
+
+The OAuth check is an RPC, so decisions are cached per credential.
+"""
+
+import collections
+import hashlib
+import json
 import logging
 import os
+import threading
+import time
+
+from google.appengine.api import users
+from google.appengine.api import oauth
+
+_OAUTH_SCOPE = 'https://www.googleapis.com/auth/plus.me'
+_POLICY_FILE = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    'table_policies.json')
+
+ANYONE = 'anyone'
+USER = 'user'
+ADMIN = 'admin'
+_LEVELS = (ANYONE, USER, ADMIN)
+_ACTIONS = ('read', 'write', 'export')
+
+_DEFAULT_POLICY = {'read': ANYONE, 'write': ADMIN, 'export': ADMIN}
+
+# How long, in seconds, a decision is cached and how many are kept.
+_CACHE_TTL = 300
+_CACHE_MAX_SIZE = 1000
+
+
+class DecisionCache(object):
+    """A thread safe cache of authorization decisions with a TTL.
+
+    When the cache is full the oldest entry is evicted.
+    """
+
+    def __init__(self, ttl, max_size):
+        self._ttl = ttl
+        self._max_size = max_size
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Return the cached decision for key, or None if there is none."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires, decision = entry
+            if expires < time.time():
+                del self._entries[key]
+                return None
+            return decision
+
+    def put(self, key, decision):
+        with self._lock:
+            if key in self._entries:
+                del self._entries[key]
+            while len(self._entries) >= self._max_size:
+                self._entries.popitem(last=False)
+            self._entries[key] = (time.time() + self._ttl, decision)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+_cache = DecisionCache(_CACHE_TTL, _CACHE_MAX_SIZE)
+_policies = None
+# Stands in for the policies when table_policies.json is invalid.
+_INVALID_POLICIES = object()
+_policies_lock = threading.Lock()
+
+
+def load_policies(path=_POLICY_FILE):
+    """Read the table policies from path.
+
+    Args:
+      path: A JSON file mapping table names to {action: level} dicts.
+    Returns:
+      A dict of table policies, empty if the file does not exist.
+    Raises:
+      ValueError: if the file is not valid JSON, is not a dict of dicts, or
+          names an unknown action or level.
+    """
+    if not os.path.exists(path):
+        return {}
+    with open(path) as policy_file:
+        policies = json.load(policy_file)
+    if not isinstance(policies, dict):
+        raise ValueError("Policies must be a dict of tables")
+    for table, policy in policies.items():
+        if not isinstance(policy, dict):
+            raise ValueError("Policy of table %s must be a dict" % table)
+        for action, level in policy.items():
+            if action not in _ACTIONS:
+                raise ValueError("Invalid action '%s' on table %s" %
+                                 (action, table))
+            if level not in _LEVELS:
+                raise ValueError("Invalid level '%s' for %s on table %s" %
+                                 (level, action, table))
+    return policies
+
+
+def get_policies():
+    """Return the table policies, loading them on first use.
+
+    Returns:
+      A dict of table policies, or None if table_policies.json is invalid.
+    """
+    global _policies
+    if _policies is None:
+        with _policies_lock:
+            if _policies is None:
+                try:
+                    _policies = load_policies(_POLICY_FILE)
+                except (ValueError, IOError):
+                    logging.exception("Invalid %s, denying all actions",
+                                      _POLICY_FILE)
+                    _policies = _INVALID_POLICIES
+    if _policies is _INVALID_POLICIES:
+        return None
+    return _policies
+
+
+def set_policies(policies):
+    """Replace the table policies and drop all cached decisions.
+
+    Args:
+      policies: A dict of table policies, or None to load them from
+          table_policies.json on next use.
+    """
+    global _policies
+    with _policies_lock:
+        _policies = policies
+    _cache.clear()
+
+
+def required_level(action, table):
+    """Return the level needed for action on table, or None to deny it."""
+    policies = get_policies()
+    if policies is None:
+        return None
+    policy = policies.get(table, {})
+    return policy.get(action, _DEFAULT_POLICY.get(action, ADMIN))
+
 
 def authorize(action, table):
+    """Decide whether the current user may perform action on table.
 
-    oauth_user = None
-    oauth_admin = None
+    Args:
+      action: The action to perform, "read", "write" or "export".
+      table: The table the action is performed on.
+    Returns:
+      True if the action is allowed, False otherwise.
+    """
+    level = required_level(action, table)
+    if level is None:
+        return False
+    if level == ANYONE:
+        return True
+
+    # The users API reads the request environment, so it is cheap.
+    user = users.get_current_user()
+    if user is not None:
+        credential = 'user:%s' % user.user_id()
+    else:
+        authorization = os.environ.get('HTTP_AUTHORIZATION')
+        if not authorization:
+            logging.debug("Unauthorized %s on %s: no credentials", action, table)
+            return False
+        if level == ADMIN:
+            logging.debug("Unauthorized %s on %s: OAuth users are not admins",
+                          action, table)
+            return False
+        credential = 'oauth:%s' % hashlib.sha1(authorization).hexdigest()
+
+    key = (credential, table, action)
+    decision = _cache.get(key)
+    if decision is not None:
+        return decision
+
+    if level == USER:
+        decision = user is not None or _check_oauth()
+    else:
+        decision = users.is_current_user_admin()
+    logging.info("Authorize %s, action: %s, table: %s, level: %s, allowed: %s",
+                 credential, action, table, level, decision)
+    _cache.put(key, decision)
+    return decision
+
+
+def _check_oauth():
+    """Return whether the request has valid OAuth credentials of a user."""
     try:
-        oauth_user = oauth.get_current_user('https://www.googleapis.com/auth/plus.me')
-        oauth_admin = oauth.is_current_user_admin('https://www.googleapis.com/auth/plus.me')
+        oauth_user = oauth.get_current_user(_OAUTH_SCOPE)
     except oauth.OAuthRequestError, e:
         logging.debug("No valid oauth credentials were received: %s" % e)
-
-    logging.info("Authorize user: %s, is admin: %s, action: %s, table: %s, oauth: %s, oauth_admin: %s" % (users.get_current_user(), users.is_current_user_admin(), action, table, oauth_user, oauth_admin))
-    logging.info("URL: %s" % users.create_login_url('/client/auth.html'))
-    
-    if action == "read":
-        return True 
-    else:
-        if users.is_current_user_admin():
-            return True
         return False
+    return oauth_user is not None
@@ -0,0 +1,241 @@
+# Copyright 2015 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Tests for jacs.auth.
+
+Run with python -m unittest jacs.auth_test from the repository root. The users
+and oauth APIs are replaced by fakes, so the App Engine SDK is optional.
+"""
+
+from __future__ import absolute_import
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from jacs import test_util
+test_util.allow_appengine_imports()
+
+from jacs import auth
+
+
+class OAuthRequestError(Exception):
+    pass
+
+
+class FakeUser(object):
+
+    def __init__(self, user_id):
+        self._user_id = user_id
+
+    def user_id(self):
+        return self._user_id
+
+
+class FakeUsers(object):
+    """Stands in for the users API, counting the calls made to it."""
+
+    def __init__(self):
+        self.user = None
+        self.admin = False
+        self.calls = 0
+
+    def get_current_user(self):
+        self.calls += 1
+        return self.user
+
+    def is_current_user_admin(self):
+        self.calls += 1
+        return self.admin
+
+
+class FakeOAuth(object):
+    """Stands in for the oauth API, counting the calls made to it."""
+
+    OAuthRequestError = OAuthRequestError
+
+    def __init__(self):
+        self.user = None
+        self.calls = 0
+
+    def get_current_user(self, scope):
+        self.calls += 1
+        if self.user is None:
+            raise OAuthRequestError('invalid token')
+        return self.user
+
+
+class FakeTime(object):
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+
+class DecisionCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self._time = auth.time
+        auth.time = self.clock = FakeTime()
+
+    def tearDown(self):
+        auth.time = self._time
+
+    def test_cached_false_is_not_a_miss(self):
+        cache = auth.DecisionCache(10, 10)
+        cache.put('a', False)
+        self.assertIs(False, cache.get('a'))
+        self.assertIsNone(cache.get('b'))
+
+    def test_entries_expire(self):
+        cache = auth.DecisionCache(10, 10)
+        cache.put('a', True)
+        self.clock.now += 10
+        self.assertTrue(cache.get('a'))
+        self.clock.now += 1
+        self.assertIsNone(cache.get('a'))
+
+    def test_oldest_entry_is_evicted(self):
+        cache = auth.DecisionCache(10, 2)
+        cache.put('a', True)
+        cache.put('b', True)
+        cache.put('a', False)
+        cache.put('c', True)
+        self.assertIsNone(cache.get('b'))
+        self.assertIs(False, cache.get('a'))
+        self.assertTrue(cache.get('c'))
+
+
+class AuthorizeTest(unittest.TestCase):
+
+    def setUp(self):
+        self._users, self._oauth = auth.users, auth.oauth
+        auth.users = self.users = FakeUsers()
+        auth.oauth = self.oauth = FakeOAuth()
+        auth.set_policies({'open': {'write': auth.ANYONE},
+                           'members': {'read': auth.USER,
+                                       'write': auth.USER}})
+        os.environ.pop('HTTP_AUTHORIZATION', None)
+
+    def tearDown(self):
+        auth.users, auth.oauth = self._users, self._oauth
+        auth.set_policies(None)
+        os.environ.pop('HTTP_AUTHORIZATION', None)
+
+    def sign_in(self, user_id='1', admin=False):
+        self.users.user = FakeUser(user_id)
+        self.users.admin = admin
+
+    def send_token(self, token='token', valid=True):
+        os.environ['HTTP_AUTHORIZATION'] = 'Bearer %s' % token
+        self.oauth.user = FakeUser('oauth') if valid else None
+
+    def test_anyone_needs_no_lookups(self):
+        self.assertTrue(auth.authorize('read', 'other'))
+        self.assertTrue(auth.authorize('write', 'open'))
+        self.assertEqual(0, self.users.calls)
+        self.assertEqual(0, self.oauth.calls)
+
+    def test_no_credentials(self):
+        self.assertFalse(auth.authorize('read', 'members'))
+        self.assertFalse(auth.authorize('write', 'other'))
+        self.assertEqual(0, self.oauth.calls)
+
+    def test_cookie_user(self):
+        self.sign_in()
+        self.assertTrue(auth.authorize('read', 'members'))
+        self.assertFalse(auth.authorize('write', 'other'))
+        self.assertFalse(auth.authorize('export', 'other'))
+        self.assertEqual(0, self.oauth.calls)
+
+    def test_cookie_admin(self):
+        self.sign_in(admin=True)
+        self.assertTrue(auth.authorize('read', 'members'))
+        self.assertTrue(auth.authorize('write', 'other'))
+        self.assertTrue(auth.authorize('export', 'other'))
+        self.assertEqual(0, self.oauth.calls)
+
+    def test_oauth_user(self):
+        self.send_token()
+        self.assertTrue(auth.authorize('read', 'members'))
+        self.assertEqual(1, self.oauth.calls)
+
+    def test_oauth_user_is_not_admin(self):
+        self.send_token()
+        self.assertFalse(auth.authorize('write', 'other'))
+        self.assertEqual(0, self.oauth.calls)
+
+    def test_decisions_are_cached_per_credential(self):
+        self.send_token()
+        self.assertTrue(auth.authorize('read', 'members'))
+        self.assertTrue(auth.authorize('read', 'members'))
+        self.assertEqual(1, self.oauth.calls)
+        self.send_token('other', valid=False)
+        self.assertFalse(auth.authorize('read', 'members'))
+        self.assertEqual(2, self.oauth.calls)
+
+    def test_failed_oauth_check_is_cached(self):
+        self.send_token(valid=False)
+        self.assertFalse(auth.authorize('read', 'members'))
+        self.assertFalse(auth.authorize('read', 'members'))
+        self.assertEqual(1, self.oauth.calls)
+
+    def test_invalid_policy_file_denies_everything(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'table_policies.json')
+        with open(path, 'w') as f:
+            f.write('{"airports": "user"}')
+        policy_file = auth._POLICY_FILE
+        auth._POLICY_FILE = path
+        self.addCleanup(setattr, auth, '_POLICY_FILE', policy_file)
+        self.sign_in(admin=True)
+        auth.set_policies(None)
+        self.assertFalse(auth.authorize('read', 'airports'))
+        self.assertFalse(auth.authorize('write', 'other'))
+
+
+class LoadPoliciesTest(unittest.TestCase):
+
+    def setUp(self):
+        self._dir = tempfile.mkdtemp()
+        self._path = os.path.join(self._dir, 'table_policies.json')
+
+    def tearDown(self):
+        shutil.rmtree(self._dir)
+
+    def load(self, text):
+        with open(self._path, 'w') as f:
+            f.write(text)
+        return auth.load_policies(self._path)
+
+    def test_missing_file(self):
+        self.assertEqual({}, auth.load_policies(self._path))
+
+    def test_valid_policies(self):
+        policies = {'airports': {'read': 'user', 'export': 'anyone'}}
+        self.assertEqual(policies, self.load(json.dumps(policies)))
+
+    def test_invalid_policies(self):
+        for text in ('{"airports": ', '["airports"]', '{"airports": "user"}',
+                     '{"airports": {"wirte": "user"}}',
+                     '{"airports": {"read": "everyone"}}'):
+            self.assertRaises(ValueError, self.load, text)
+
+
+if __name__ == '__main__':
+    unittest.main()
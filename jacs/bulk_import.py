@@ -0,0 +1,509 @@
+# Copyright 2015 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Import large GeoJSON or newline-delimited GeoJSON files into a table.
+
+The file is read incrementally and cut into chunks. Each chunk is verified
+against the table columns and its geometries are encoded as WKB in a process
+pool, while earlier chunks are inserted, each in its own transaction. At most
+max_pending chunks are in flight, so memory use does not grow with the file.
+
+After every chunk, the number of committed features is stored in
+<file>.checkpoint, and a failed import is resumed from there. The chunk that
+was being inserted when an import died may have been committed already, so
+rows of the first chunk after a resume whose primary key is in the table are
+skipped; rows without a primary key can't be told apart and are inserted.
+For very large loads the spatial indexes of the table can be dropped during
+the import and rebuilt afterwards. The dropped indexes are stored in the
+checkpoint first, so they are rebuilt by the next run if this one dies.
+
+This is meant to be run from the command line, outside App Engine, with the
+libraries of requirements.txt and MySQLdb on the path, e.g.
+PYTHONPATH=lib python -m jacs.bulk_import \
+    mysql+mysqldb://root:pw@host/db airports a.ndjson
+"""
+
+import argparse
+import collections
+import json
+import logging
+import multiprocessing
+import os
+import re
+import time
+
+import geomet.wkb
+import sqlalchemy
+import sqlalchemy.exc
+
+import feature_util
+import types
+
+NDJSON = 'ndjson'
+GEOJSON = 'geojson'
+
+_READ_SIZE = 64 * 1024
+# No single feature may be larger than this, so memory use stays bounded.
+_MAX_VALUE_SIZE = 64 * 1024 * 1024
+
+_STRUCTURE = re.compile(r'["{}\[\]]')
+_STRING_END = re.compile(r'["\\]')
+_SCALAR_END = re.compile(r'[\s,:\]}]')
+
+
+def read_ndjson(f):
+    """Yield the features of a file with one GeoJSON Feature per line."""
+    for line in f:
+        line = line.strip()
+        if line:
+            yield json.loads(line)
+
+
+class _JSONReader(object):
+    """Reads JSON values from a file, reading more of it when needed.
+
+    When a value can't be decoded, its end is found by scanning for brackets
+    and strings: more of the file is only read while the value is incomplete,
+    and an invalid value is reported right away.
+    """
+
+    def __init__(self, f):
+        self._f = f
+        self._buf = ''
+        self._eof = False
+        self._decoder = json.JSONDecoder()
+        # The position, bracket depth and whether in a string of the scan.
+        self._scan = (0, 0, False)
+
+    def _read(self):
+        if self._eof:
+            raise ValueError('Unexpected end of file')
+        data = self._f.read(_READ_SIZE)
+        self._eof = not data
+        self._buf += data
+
+    def peek(self):
+        """Return the next character that is not whitespace."""
+        while True:
+            self._buf = self._buf.lstrip()
+            if self._buf:
+                return self._buf[0]
+            self._read()
+
+    def expect(self, *chars):
+        """Consume and return the next character, which must be in chars."""
+        char = self.peek()
+        if char not in chars:
+            raise ValueError("Expected %s but found '%s'" %
+                             (' or '.join(chars), char))
+        self._buf = self._buf[1:]
+        return char
+
+    def _value_end(self):
+        """Return the end of the value the buffer starts with.
+
+        Returns:
+          The index after the value, or None if the buffer ends first.
+        """
+        buf = self._buf
+        if buf[0] not in '{["':
+            # A number or literal ends at the next delimiter.
+            match = _SCALAR_END.search(buf)
+            return match.start() if match else None
+        pos, depth, in_string = self._scan
+        while True:
+            if in_string:
+                match = _STRING_END.search(buf, pos)
+                if match is None:
+                    pos = len(buf)
+                    break
+                if match.group() == '\\':
+                    if match.end() == len(buf):
+                        # Scan the escape again when the rest is read.
+                        pos = match.start()
+                        break
+                    pos = match.end() + 1
+                    continue
+                in_string = False
+                pos = match.end()
+                if depth == 0:
+                    return pos
+            else:
+                match = _STRUCTURE.search(buf, pos)
+                if match is None:
+                    pos = len(buf)
+                    break
+                pos = match.end()
+                char = match.group()
+                if char == '"':
+                    in_string = True
+                elif char in '{[':
+                    depth += 1
+                else:
+                    depth -= 1
+                    if depth == 0:
+                        return pos
+        self._scan = (pos, depth, in_string)
+        return None
+
+    def decode(self):
+        """Consume and return the next JSON value."""
+        self.peek()
+        self._scan = (0, 0, False)
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self._buf)
+            except ValueError:
+                if self._value_end() is not None:
+                    raise
+                # The value is incomplete, read up to its end.
+                while self._value_end() is None:
+                    if len(self._buf) > _MAX_VALUE_SIZE:
+                        raise ValueError('Value is larger than %d bytes' %
+                                         _MAX_VALUE_SIZE)
+                    self._read()
+                continue
+            if end == len(self._buf) and not self._eof:
+                # A number may continue in the next read.
+                self._read()
+                continue
+            self._buf = self._buf[end:]
+            return value
+
+
+def read_feature_collection(f):
+    """Yield the features of a GeoJSON FeatureCollection file one by one.
+
+    Only the current feature is held in memory, not the whole collection.
+    """
+    reader = _JSONReader(f)
+    reader.expect('{')
+    # Skip the members of the collection that come before the features.
+    while True:
+        key = reader.decode()
+        reader.expect(':')
+        if key == 'features':
+            break
+        reader.decode()
+        if reader.expect(',', '}') == '}':
+            raise ValueError('No features found')
+
+    reader.expect('[')
+    if reader.peek() == ']':
+        return
+    index = 0
+    while True:
+        try:
+            feature = reader.decode()
+            last = reader.expect(',', ']') == ']'
+        except ValueError as e:
+            raise ValueError('Feature %d: %s' % (index, e))
+        yield feature
+        if last:
+            return
+        index += 1
+
+
+def read_features(f, fmt):
+    if fmt == NDJSON:
+        return read_ndjson(f)
+    return read_feature_collection(f)
+
+
+def guess_format(path):
+    if os.path.splitext(path)[1].lower() in ('.ndjson', '.jsonl'):
+        return NDJSON
+    return GEOJSON
+
+
+def chunks(features, chunk_size, skip=0):
+    """Yield (index of the first feature, list of features) chunks."""
+    chunk = []
+    start = skip
+    for index, feature in enumerate(features):
+        if index < skip:
+            continue
+        chunk.append(feature)
+        if len(chunk) == chunk_size:
+            yield start, chunk
+            start += len(chunk)
+            chunk = []
+    if chunk:
+        yield start, chunk
+
+
+def prepare_chunk(args):
+    """Verify a chunk of features and turn it into rows to insert.
+
+    This runs in the worker processes.
+
+    Args:
+      args: A (columns, geometry_field, start, features) tuple, where start is
+          the index of the first feature in the file.
+    Returns:
+      A list of rows on success, or a dict explaining the error.
+    """
+    columns, geometry_field, start, features = args
+    rows = []
+    for index, feature in enumerate(features, start):
+        if not isinstance(feature, dict):
+            return feature_util.error_message('Feature is not an object',
+                                              index=index)
+        if not feature.get('geometry'):
+            return feature_util.error_message('Missing geometry', index=index)
+        properties = feature.get('properties') or {}
+        try:
+            feature_util.verify_attributes(columns, properties)
+            properties[geometry_field] = geomet.wkb.dumps(feature['geometry'])
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            return feature_util.error_message(str(e), index=index)
+        rows.append(properties)
+    return rows
+
+
+class Importer(object):
+    """Imports files of features into tables."""
+
+    def __init__(self, engine, geometry_field, chunk_size=1000,
+                 processes=None, max_pending=None):
+        """
+        Args:
+          engine: A sqlalchemy Cloud SQL engine
+          geometry_field: The field that the geometry is stored in.
+          chunk_size: The number of features inserted per transaction.
+          processes: The number of worker processes, one per CPU if None.
+          max_pending: The number of chunks that are prepared ahead of the
+              inserts, twice the number of processes if None.
+        """
+        self._engine = engine
+        self._geometry_field = geometry_field
+        self._chunk_size = chunk_size
+        self._processes = processes or multiprocessing.cpu_count()
+        self._max_pending = max_pending or 2 * self._processes
+        self._metadata = sqlalchemy.MetaData()
+
+    def initialize_table(self, table):
+        if table in self._metadata.tables:
+            return self._metadata.tables[table]
+        return sqlalchemy.Table(
+                table, self._metadata,
+                sqlalchemy.Column(self._geometry_field, types.WKBGeometry),
+                autoload=True, autoload_with=self._engine)
+
+    def run(self, table, path, fmt=None, resume=True,
+            rebuild_spatial_index=False):
+        """Import the features in path into table.
+
+        Args:
+          table: The Table to import into.
+          path: The GeoJSON or NDJSON file to import.
+          fmt: NDJSON or GEOJSON, guessed from the file extension if None.
+          resume: Whether to continue from the checkpoint of an earlier import.
+          rebuild_spatial_index: Whether to drop the spatial indexes of the
+              table during the import and rebuild them afterwards.
+        Returns:
+          On success a dictionary with import statistics is returned.
+          On error, a dictionary with error information is returned.
+        """
+        checkpoint_path = path + '.checkpoint'
+        checkpoint = {'table': table, 'committed': 0, 'spatial_indexes': []}
+        if os.path.exists(checkpoint_path):
+            with open(checkpoint_path) as f:
+                stored = json.load(f)
+            if stored['table'] == table:
+                # Indexes dropped by an earlier run are always rebuilt.
+                checkpoint['spatial_indexes'] = stored.get(
+                        'spatial_indexes', [])
+                if resume:
+                    checkpoint['committed'] = stored['committed']
+                    logging.info('Resuming import of %s after %d features',
+                                 path, checkpoint['committed'])
+        skip = checkpoint['committed']
+
+        tbl = self.initialize_table(table)
+        columns = set(tbl.columns.keys())
+        if rebuild_spatial_index:
+            indexes = self._spatial_indexes(table)
+            checkpoint['spatial_indexes'].extend(
+                    i for i in indexes if i not in checkpoint['spatial_indexes'])
+            _save_checkpoint(checkpoint_path, checkpoint)
+            self._drop_spatial_indexes(table, indexes)
+
+        started = time.time()
+        pool = multiprocessing.Pool(self._processes)
+        try:
+            with open(path, 'rb') as f:
+                pending = collections.deque()
+                work = chunks(read_features(f, fmt or guess_format(path)),
+                              self._chunk_size, skip)
+                # The first chunk after a resume may have been committed.
+                skip_existing = skip > 0
+                for start, chunk in work:
+                    pending.append(pool.apply_async(prepare_chunk, [(
+                            columns, self._geometry_field, start, chunk)]))
+                    # Wait for the oldest chunk when too many are in flight.
+                    if len(pending) >= self._max_pending:
+                        self._insert(tbl, pending.popleft().get(), checkpoint,
+                                     checkpoint_path, skip_existing)
+                        skip_existing = False
+                while pending:
+                    self._insert(tbl, pending.popleft().get(), checkpoint,
+                                 checkpoint_path, skip_existing)
+                    skip_existing = False
+        except _ImportError as e:
+            return e.error
+        except (ValueError, IOError) as e:
+            return feature_util.error_message(
+                    "Unable to read %s: %s" % (path, e),
+                    index=checkpoint['committed'])
+        finally:
+            pool.terminate()
+            if checkpoint['spatial_indexes']:
+                self._create_spatial_indexes(table,
+                                             checkpoint['spatial_indexes'])
+                checkpoint['spatial_indexes'] = []
+                _save_checkpoint(checkpoint_path, checkpoint)
+
+        if os.path.exists(checkpoint_path):
+            os.remove(checkpoint_path)
+        elapsed = time.time() - started
+        imported = checkpoint['committed'] - skip
+        return {
+            'features': imported,
+            'resumed_after': skip,
+            'elapsed': elapsed,
+            'features_per_second': imported / elapsed if elapsed else None,
+        }
+
+    def _insert(self, tbl, rows, checkpoint, checkpoint_path, skip_existing):
+        """Insert a prepared chunk and store the checkpoint.
+
+        Args:
+          tbl: The Table to insert into.
+          rows: The rows returned by prepare_chunk.
+          checkpoint: The checkpoint to update with the committed features.
+          checkpoint_path: Where to store the checkpoint.
+          skip_existing: Whether to skip rows whose primary key is in tbl.
+        """
+        if isinstance(rows, dict):
+            raise _ImportError(rows)
+        count = len(rows)
+        connection = self._engine.connect()
+        transaction = connection.begin()
+        try:
+            if skip_existing:
+                rows = self._without_existing(connection, tbl, rows)
+            if rows:
+                connection.execute(tbl.insert(), rows)
+            transaction.commit()
+        except sqlalchemy.exc.SQLAlchemyError as e:
+            transaction.rollback()
+            raise _ImportError(feature_util.error_message(
+                    "Database error: %s" % e, index=checkpoint['committed']))
+        finally:
+            connection.close()
+        checkpoint['committed'] += count
+        _save_checkpoint(checkpoint_path, checkpoint)
+
+    def _without_existing(self, connection, tbl, rows):
+        """Return the rows whose primary key is not in tbl yet."""
+        key_columns = list(tbl.primary_key.columns)
+        names = [c.name for c in key_columns]
+        keyed = [row for row in rows if all(n in row for n in names)]
+        if not key_columns or not keyed:
+            return rows
+        if len(key_columns) == 1:
+            condition = key_columns[0].in_([row[names[0]] for row in keyed])
+        else:
+            condition = sqlalchemy.tuple_(*key_columns).in_(
+                    [tuple(row[n] for n in names) for row in keyed])
+        existing = set(
+                tuple(unicode(v) for v in key) for key in connection.execute(
+                        sqlalchemy.sql.select(key_columns).where(condition)))
+        if existing:
+            logging.info('Skipping %d features that were already imported',
+                         len(existing))
+        return [row for row in rows
+                if tuple(unicode(row.get(n)) for n in names) not in existing]
+
+    def _spatial_indexes(self, table):
+        """Return a list of [index name, column] of the spatial indexes."""
+        quoted = self._engine.dialect.identifier_preparer.quote(table)
+        indexes = []
+        for row in self._engine.execute('SHOW INDEX FROM %s' % quoted):
+            if row['Index_type'] == 'SPATIAL':
+                indexes.append([row['Key_name'], row['Column_name']])
+        return indexes
+
+    def _drop_spatial_indexes(self, table, indexes):
+        preparer = self._engine.dialect.identifier_preparer
+        for name, _ in indexes:
+            logging.info('Dropping spatial index %s of %s', name, table)
+            self._engine.execute('ALTER TABLE %s DROP INDEX %s' % (
+                    preparer.quote(table), preparer.quote(name)))
+
+    def _create_spatial_indexes(self, table, indexes):
+        """Create the indexes that are not in table already."""
+        preparer = self._engine.dialect.identifier_preparer
+        existing = [name for name, _ in self._spatial_indexes(table)]
+        for name, column in indexes:
+            if name in existing:
+                continue
+            logging.info('Rebuilding spatial index %s of %s', name, table)
+            self._engine.execute('ALTER TABLE %s ADD SPATIAL INDEX %s (%s)' % (
+                    preparer.quote(table), preparer.quote(name),
+                    preparer.quote(column)))
+
+
+def _save_checkpoint(path, checkpoint):
+    # Write to a temporary file first, so the checkpoint is never partial.
+    with open(path + '.tmp', 'w') as f:
+        json.dump(checkpoint, f)
+    os.rename(path + '.tmp', path)
+
+
+class _ImportError(Exception):
+    """Stops an import with an error_message dict."""
+
+    def __init__(self, error):
+        Exception.__init__(self, error['error'])
+        self.error = error
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('engine', help='sqlalchemy database URL')
+    parser.add_argument('table')
+    parser.add_argument('path', help='GeoJSON or NDJSON file')
+    parser.add_argument('--format', choices=(NDJSON, GEOJSON))
+    parser.add_argument('--geometry-field', default='geometry')
+    parser.add_argument('--chunk-size', type=int, default=1000)
+    parser.add_argument('--processes', type=int)
+    parser.add_argument('--restart', action='store_true',
+                        help='ignore the checkpoint of an earlier import')
+    parser.add_argument('--rebuild-spatial-index', action='store_true')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    importer = Importer(sqlalchemy.create_engine(args.engine),
+                        args.geometry_field, chunk_size=args.chunk_size,
+                        processes=args.processes)
+    result = importer.run(args.table, args.path, fmt=args.format,
+                          resume=not args.restart,
+                          rebuild_spatial_index=args.rebuild_spatial_index)
+    print json.dumps(result)
+    return 1 if 'error' in result else 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,236 @@
+# Copyright 2015 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Tests for jacs.bulk_import.
+
+Run with python -m unittest jacs.bulk_import_test from the repository root.
+"""
+
+import json
+import os
+import shutil
+import StringIO
+import tempfile
+import unittest
+
+import geomet.wkb
+import sqlalchemy
+
+from jacs import bulk_import
+
+
+def _feature(i, name=None):
+    return {'type': 'Feature',
+            'geometry': {'type': 'Point', 'coordinates': [i, 1]},
+            'properties': {'id': i, 'name': name or 'p%d' % i}}
+
+
+class ReadFeatureCollectionTest(unittest.TestCase):
+
+    def setUp(self):
+        self._read_size = bulk_import._READ_SIZE
+
+    def tearDown(self):
+        bulk_import._READ_SIZE = self._read_size
+
+    def read(self, text):
+        return list(bulk_import.read_feature_collection(
+                StringIO.StringIO(text)))
+
+    def test_reads_all_features(self):
+        features = [_feature(i) for i in range(5)]
+        collection = {'type': 'FeatureCollection', 'features': features}
+        self.assertEqual(features, self.read(json.dumps(collection)))
+
+    def test_features_split_across_reads(self):
+        bulk_import._READ_SIZE = 7
+        features = [_feature(i) for i in range(100, 120)]
+        text = json.dumps({'type': 'FeatureCollection', 'features': features},
+                          indent=2)
+        self.assertEqual(features, self.read(text))
+
+    def test_number_split_across_reads(self):
+        bulk_import._READ_SIZE = 1
+        features = [_feature(123456789)]
+        self.assertEqual(features, self.read(json.dumps({'features': features})))
+
+    def test_stray_features_key_is_skipped(self):
+        features = [_feature(1, name='features')]
+        text = ('{"type": "FeatureCollection", '
+                '"crs": {"properties": {"features": ["not", "these"]}}, '
+                '"name": "features", "features": %s}' % json.dumps(features))
+        self.assertEqual(features, self.read(text))
+
+    def test_members_after_features_are_ignored(self):
+        features = [_feature(1)]
+        text = '{"features": %s, "bbox": [0, 0, 1, 1]}' % json.dumps(features)
+        self.assertEqual(features, self.read(text))
+
+    def test_empty_and_trailing_bracket(self):
+        self.assertEqual([], self.read('{"features": [ ] }'))
+        self.assertEqual([_feature(1)],
+                         self.read('{"features": [%s\n]\n}' %
+                                   json.dumps(_feature(1))))
+
+    def test_no_features(self):
+        self.assertRaises(ValueError, self.read, '{"type": "FeatureCollection"}')
+
+    def test_truncated_file(self):
+        text = json.dumps({'features': [_feature(1), _feature(2)]})[:-20]
+        self.assertRaises(ValueError, self.read, text)
+
+    def test_invalid_separator(self):
+        text = '{"features": [%s; %s]}' % (json.dumps(_feature(1)),
+                                           json.dumps(_feature(2)))
+        self.assertRaises(ValueError, self.read, text)
+
+    def test_invalid_feature_fails_without_reading_on(self):
+        bulk_import._READ_SIZE = 1024
+        features = ',\n'.join(json.dumps(_feature(i)) for i in range(20000))
+        text = StringIO.StringIO(
+                '{"features": [%s,\n{"a": tru}, %s]}' % (
+                        json.dumps(_feature(0)), features))
+        with self.assertRaisesRegexp(ValueError, '^Feature 1: '):
+            list(bulk_import.read_feature_collection(text))
+        self.assertLess(text.tell(), 4096)
+
+    def test_escaped_quote_split_across_reads(self):
+        bulk_import._READ_SIZE = 1
+        features = [_feature(1, name='a "quoted\\" name')]
+        self.assertEqual(features, self.read(json.dumps({'features': features})))
+
+    def test_feature_too_large(self):
+        bulk_import._READ_SIZE = 10
+        bulk_import._MAX_VALUE_SIZE, max_size = 100, bulk_import._MAX_VALUE_SIZE
+        try:
+            text = json.dumps({'features': [_feature(1, name='x' * 1000)]})
+            with self.assertRaisesRegexp(ValueError, '^Feature 0: '):
+                self.read(text)
+        finally:
+            bulk_import._MAX_VALUE_SIZE = max_size
+
+
+class ChunksTest(unittest.TestCase):
+
+    def test_chunks_with_skip(self):
+        self.assertEqual([(2, [2, 3]), (4, [4])],
+                         list(bulk_import.chunks(range(5), 2, skip=2)))
+
+
+class PrepareChunkTest(unittest.TestCase):
+
+    def test_encodes_geometry_as_wkb(self):
+        rows = bulk_import.prepare_chunk(
+                (set(['id', 'name', 'geometry']), 'geometry', 0, [_feature(1)]))
+        self.assertEqual({'type': 'Point', 'coordinates': [1, 1]},
+                         geomet.wkb.loads(rows[0].pop('geometry')))
+        self.assertEqual({'id': 1, 'name': 'p1'}, rows[0])
+
+    def test_invalid_attribute_reports_index(self):
+        features = [_feature(1), {'geometry': None, 'properties': {'x': 1}}]
+        error = bulk_import.prepare_chunk(
+                (set(['id', 'name', 'geometry']), 'geometry', 10, features))
+        self.assertEqual(11, error['index'])
+
+
+    def test_missing_geometry_reports_index(self):
+        features = [_feature(1), {'type': 'Feature', 'geometry': None,
+                                  'properties': {'id': 2}}]
+        error = bulk_import.prepare_chunk(
+                (set(['id', 'name', 'geometry']), 'geometry', 0, features))
+        self.assertEqual(1, error['index'])
+        self.assertIn('Missing geometry', error['error'])
+
+    def test_feature_that_is_not_an_object_reports_index(self):
+        error = bulk_import.prepare_chunk(
+                (set(['id', 'name', 'geometry']), 'geometry', 5, [[1, 2]]))
+        self.assertEqual(5, error['index'])
+
+
+class ImporterTest(unittest.TestCase):
+    """Imports into SQLite, which stores the WKB as it is."""
+
+    def setUp(self):
+        self._dir = tempfile.mkdtemp()
+        self._engine = sqlalchemy.create_engine(
+                'sqlite:///%s' % os.path.join(self._dir, 'db.sqlite'))
+
+        @sqlalchemy.event.listens_for(self._engine, 'connect')
+        def connect(connection, _):
+            connection.create_function('ST_AsWkb', 1, lambda x: x)
+            connection.create_function('ST_GeomFromWKB', 1, lambda x: x)
+
+        self._engine.execute('CREATE TABLE pts (id INTEGER PRIMARY KEY, '
+                             'name TEXT, geometry BLOB)')
+        self._path = os.path.join(self._dir, 'pts.ndjson')
+        with open(self._path, 'w') as f:
+            for i in range(1, 11):
+                f.write(json.dumps(_feature(i)) + '\n')
+
+    def tearDown(self):
+        shutil.rmtree(self._dir)
+
+    def run_import(self):
+        importer = bulk_import.Importer(self._engine, 'geometry',
+                                        chunk_size=3, processes=1)
+        return importer.run('pts', self._path)
+
+    def count(self):
+        return self._engine.execute('SELECT COUNT(*) FROM pts').scalar()
+
+    def test_import(self):
+        result = self.run_import()
+        self.assertEqual(10, result['features'])
+        self.assertEqual(10, self.count())
+        self.assertFalse(os.path.exists(self._path + '.checkpoint'))
+
+    def test_resume_skips_chunk_committed_before_checkpoint(self):
+        # The first 6 features were committed, but the checkpoint was only
+        # written for the first 3.
+        for i in range(1, 7):
+            self._engine.execute('INSERT INTO pts VALUES (?, ?, ?)',
+                                 i, 'p%d' % i, '')
+        with open(self._path + '.checkpoint', 'w') as f:
+            json.dump({'table': 'pts', 'committed': 3}, f)
+        result = self.run_import()
+        self.assertNotIn('error', result)
+        self.assertEqual(3, result['resumed_after'])
+        self.assertEqual(10, self.count())
+
+    def test_dropped_spatial_indexes_are_rebuilt_after_a_crash(self):
+        created = []
+
+        class CrashingImporter(bulk_import.Importer):
+            def _spatial_indexes(self, table):
+                return [['sp', 'geometry']]
+
+            def _drop_spatial_indexes(self, table, indexes):
+                raise KeyboardInterrupt()
+
+            def _create_spatial_indexes(self, table, indexes):
+                created.extend(indexes)
+
+        importer = CrashingImporter(self._engine, 'geometry', processes=1)
+        self.assertRaises(KeyboardInterrupt, importer.run, 'pts', self._path,
+                          rebuild_spatial_index=True)
+        with open(self._path + '.checkpoint') as f:
+            self.assertEqual([['sp', 'geometry']],
+                             json.load(f)['spatial_indexes'])
+
+        importer.run('pts', self._path)
+        self.assertEqual([['sp', 'geometry']], created)
+        self.assertFalse(os.path.exists(self._path + '.checkpoint'))
+
+
+if __name__ == '__main__':
+    unittest.main()
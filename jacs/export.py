@@ -0,0 +1,283 @@
+# Copyright 2015 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Export whole tables to chunked files.
+
+A table is walked in primary key order, chunk_size features at a time, using
+Features.query_rows. Every chunk is written to its own file:
+  exports/<job id>/<table>-00000.ndjson  one GeoJSON Feature per line, or
+  exports/<job id>/<table>-00000.bin     the format described in encode_binary.
+After every chunk exports/<job id>/manifest.json is updated with the state,
+progress and last exported primary key of the job. The manifest is all there
+is to a job, so any instance can report on it or export its next chunk, and
+an interrupted export is resumed from the last chunk.
+
+On App Engine each chunk is exported by a task, see api.py.
+"""
+
+import decimal
+import json
+import os
+import re
+import struct
+import time
+import uuid
+
+import geojson
+import geomet.wkb
+
+import features as features_lib
+
+NDJSON = 'ndjson'
+BINARY = 'bin'
+FORMATS = (NDJSON, BINARY)
+
+_BINARY_MAGIC = 'JACSF1'
+_MANIFEST = 'manifest.json'
+_JOB_ID = re.compile(r'^[0-9a-f]{32}$')
+
+RUNNING = 'running'
+DONE = 'done'
+ERROR = 'error'
+
+
+def encode_ndjson(features):
+    """Encode features as newline-delimited GeoJSON."""
+    return ''.join(geojson.dumps(f, sort_keys=True) + '\n' for f in features)
+
+
+def encode_binary(features):
+    """Encode features in a compact binary format.
+
+    The chunk starts with _BINARY_MAGIC, followed by one record per feature:
+    a big-endian uint32 length and the JSON of the properties, then a uint32
+    length and the WKB of the geometry.
+    """
+    parts = [_BINARY_MAGIC]
+    for feature in features:
+        properties = json.dumps(feature['properties'], sort_keys=True)
+        wkb = geomet.wkb.dumps(feature['geometry'])
+        parts.append(struct.pack('>I', len(properties)))
+        parts.append(properties)
+        parts.append(struct.pack('>I', len(wkb)))
+        parts.append(wkb)
+    return ''.join(parts)
+
+
+_ENCODERS = {NDJSON: encode_ndjson, BINARY: encode_binary}
+
+
+def _dump_key(key):
+    """Return key in a form that JSON can store without losing precision."""
+    if isinstance(key, decimal.Decimal):
+        return {'decimal': str(key)}
+    return key
+
+
+def _load_key(key):
+    if isinstance(key, dict):
+        return decimal.Decimal(key['decimal'])
+    return key
+
+
+def is_valid_job_id(job_id):
+    return bool(job_id and _JOB_ID.match(job_id))
+
+
+class LocalStorage(object):
+    """Stores export files in a local directory.
+
+    This is for running exports outside App Engine, e.g. from a script. The
+    dev_appserver sandbox does not allow writing files, use CloudStorage there;
+    the development server stores its files locally.
+    """
+
+    def __init__(self, directory):
+        self._directory = directory
+
+    def write(self, name, data):
+        path = os.path.join(self._directory, name)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        # Write to a temporary file first, so a file is complete or absent.
+        with open(path + '.tmp', 'wb') as f:
+            f.write(data)
+        os.rename(path + '.tmp', path)
+
+    def read(self, name):
+        """Return the contents of name, or None if it does not exist."""
+        path = os.path.join(self._directory, name)
+        if not os.path.exists(path):
+            return None
+        with open(path, 'rb') as f:
+            return f.read()
+
+
+class CloudStorage(object):
+    """Stores export files in a Google Cloud Storage bucket."""
+
+    def __init__(self, bucket):
+        # The GCS client library is only needed when exporting on App Engine.
+        import cloudstorage
+        self._gcs = cloudstorage
+        self._bucket = bucket
+
+    def write(self, name, data):
+        path = '/%s/%s' % (self._bucket, name)
+        with self._gcs.open(path, 'w') as f:
+            f.write(data)
+
+    def read(self, name):
+        """Return the contents of name, or None if it does not exist."""
+        path = '/%s/%s' % (self._bucket, name)
+        try:
+            with self._gcs.open(path) as f:
+                return f.read()
+        except self._gcs.NotFoundError:
+            return None
+
+
+class ExportJob(object):
+    """Exports one table to storage, chunk by chunk."""
+
+    def __init__(self, storage, manifest, job_id=None):
+        """Use create or load rather than this.
+
+        Args:
+          storage: A LocalStorage or CloudStorage to write the files to.
+          manifest: The state of the job, see create.
+          job_id: The id of the job, a new id is made if None.
+        """
+        self.job_id = job_id or uuid.uuid4().hex
+        if not is_valid_job_id(self.job_id):
+            raise ValueError("Invalid export id: %s" % self.job_id)
+        self.manifest = manifest
+        self._storage = storage
+        self._prefix = 'exports/%s' % self.job_id
+
+    @classmethod
+    def create(cls, storage, table, fmt=NDJSON, chunk_size=1000):
+        """Make a new export job of table.
+
+        Args:
+          storage: A LocalStorage or CloudStorage to write the files to.
+          table: The table to export.
+          fmt: The file format, NDJSON or BINARY.
+          chunk_size: The number of features in each file.
+        """
+        if fmt not in FORMATS:
+            raise ValueError("Invalid format: %s" % fmt)
+        if chunk_size < 1:
+            raise ValueError("Invalid chunk size: %s" % chunk_size)
+        return cls(storage, {
+            'table': table,
+            'format': fmt,
+            'chunk_size': chunk_size,
+            'state': RUNNING,
+            'error': None,
+            'runs': 0,
+            'chunks': 0,
+            'features': 0,
+            'bytes': 0,
+            'elapsed': 0.0,
+            'last_key': None,
+        })
+
+    @classmethod
+    def load(cls, storage, job_id):
+        """Return the stored job with job_id, or None if there is none."""
+        if not is_valid_job_id(job_id):
+            raise ValueError("Invalid export id: %s" % job_id)
+        data = storage.read('exports/%s/%s' % (job_id, _MANIFEST))
+        if data is None:
+            return None
+        return cls(storage, json.loads(data), job_id)
+
+    def save(self):
+        self._storage.write('%s/%s' % (self._prefix, _MANIFEST),
+                            json.dumps(self.manifest))
+
+    def check(self, features):
+        """Raise ValueError if the table can't be exported.
+
+        Args:
+          features: A Features instance to query the table with.
+        Raises:
+          ValueError: if the table has no single column primary key.
+          sqlalchemy.exc.NoSuchTableError: if the table does not exist.
+        """
+        tbl = features.initialize_table(self.manifest['table'])
+        if len(tbl.primary_key.columns) != 1:
+            raise ValueError('Exports need a single column primary key')
+
+    def run_chunk(self, features):
+        """Export the next chunk and save the manifest.
+
+        Args:
+          features: A Features instance to query the table with.
+        Returns:
+          True if the whole table has been exported.
+        """
+        started = time.time()
+        manifest = self.manifest
+        table = manifest['table']
+        tbl = features.initialize_table(table)
+        primary_key = features_lib.get_primary_key(tbl)
+        rows = features.query_rows(
+                table, '', None, limit=manifest['chunk_size'],
+                order_by=primary_key.name,
+                after=_load_key(manifest['last_key']))
+        if isinstance(rows, dict):
+            raise ValueError(rows['error'])
+        chunk = [features.row_to_feature(row, primary_key) for row in rows]
+        if chunk:
+            data = _ENCODERS[manifest['format']](chunk)
+            self._storage.write('%s/%s-%05d.%s' % (
+                    self._prefix, table, manifest['chunks'],
+                    manifest['format']), data)
+            manifest['chunks'] += 1
+            manifest['features'] += len(chunk)
+            manifest['bytes'] += len(data)
+            # The raw key, since the feature id is converted to a string.
+            manifest['last_key'] = _dump_key(rows[-1][primary_key.name])
+        if len(chunk) < manifest['chunk_size']:
+            manifest['state'] = DONE
+        manifest['elapsed'] += time.time() - started
+        self.save()
+        return manifest['state'] == DONE
+
+    def run(self, features):
+        """Export all remaining chunks, for use outside App Engine."""
+        self.check(features)
+        self.manifest['state'] = RUNNING
+        self.manifest['error'] = None
+        try:
+            while not self.run_chunk(features):
+                pass
+        except Exception as e:
+            self.fail(e)
+            raise
+
+    def fail(self, error):
+        self.manifest['state'] = ERROR
+        self.manifest['error'] = str(error)
+        self.save()
+
+    def status(self):
+        """Return the progress and throughput of the job as a dict."""
+        status = dict(self.manifest)
+        status['job_id'] = self.job_id
+        if status['elapsed'] > 0:
+            status['features_per_second'] = (
+                    status['features'] / status['elapsed'])
+        return status
@@ -0,0 +1,182 @@
+# Copyright 2015 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Tests for jacs.export.
+
+Run with python -m unittest jacs.export_test from the repository root.
+"""
+
+from __future__ import absolute_import
+
+import decimal
+import json
+import shutil
+import struct
+import tempfile
+import unittest
+
+import geomet.wkb
+import sqlalchemy
+import sqlalchemy.exc
+
+from jacs import test_util
+test_util.allow_appengine_imports()
+
+from jacs import export
+from jacs import features
+
+
+def _feature(i):
+    return {'type': 'Feature', 'id': str(i),
+            'geometry': {'type': 'Point', 'coordinates': [float(i), 1.0]},
+            'properties': {'id': str(i), 'name': 'p%d' % i}}
+
+
+class EncodeTest(unittest.TestCase):
+
+    def test_ndjson(self):
+        data = export.encode_ndjson([_feature(1), _feature(2)])
+        lines = data.split('\n')
+        self.assertEqual('', lines[-1])
+        self.assertEqual([_feature(1), _feature(2)],
+                         [json.loads(line) for line in lines[:-1]])
+
+    def test_binary_record_layout(self):
+        data = export.encode_binary([_feature(1), _feature(2)])
+        self.assertTrue(data.startswith('JACSF1'))
+        offset = len('JACSF1')
+        for i in (1, 2):
+            length, = struct.unpack('>I', data[offset:offset + 4])
+            offset += 4
+            self.assertEqual(_feature(i)['properties'],
+                             json.loads(data[offset:offset + length]))
+            offset += length
+            length, = struct.unpack('>I', data[offset:offset + 4])
+            offset += 4
+            self.assertEqual(_feature(i)['geometry'],
+                             geomet.wkb.loads(data[offset:offset + length]))
+            offset += length
+        self.assertEqual(len(data), offset)
+
+    def test_decimal_keys_keep_their_precision(self):
+        key = decimal.Decimal('12345678901234567890.123')
+        stored = json.loads(json.dumps(export._dump_key(key)))
+        self.assertEqual(key, export._load_key(stored))
+        self.assertEqual(7, export._load_key(json.loads(json.dumps(7))))
+
+
+class FailingStorage(export.LocalStorage):
+    """Fails to write the chunk file with the given name."""
+
+    def __init__(self, directory, fail):
+        export.LocalStorage.__init__(self, directory)
+        self._fail = fail
+
+    def write(self, name, data):
+        if name.endswith(self._fail):
+            raise IOError('write failed')
+        export.LocalStorage.write(self, name, data)
+
+
+class ExportJobTest(unittest.TestCase):
+    """Exports from SQLite, which stores the WKB as it is."""
+
+    def setUp(self):
+        self._dir = tempfile.mkdtemp()
+        self._storage = export.LocalStorage(self._dir)
+        engine = sqlalchemy.create_engine('sqlite://')
+
+        @sqlalchemy.event.listens_for(engine, 'connect')
+        def connect(connection, _):
+            connection.create_function('ST_AsWkb', 1, lambda x: x)
+
+        engine.execute('CREATE TABLE pts (id INTEGER PRIMARY KEY, '
+                       'name TEXT, geometry BLOB)')
+        engine.execute('CREATE TABLE pairs (a INTEGER, b INTEGER, '
+                       'geometry BLOB, PRIMARY KEY (a, b))')
+        for i in range(1, 10):
+            engine.execute('INSERT INTO pts VALUES (?, ?, ?)', i, 'p%d' % i,
+                           buffer(geomet.wkb.dumps(_feature(i)['geometry'])))
+        self._features = features.Features(engine, 'geometry')
+
+    def tearDown(self):
+        shutil.rmtree(self._dir)
+
+    def exported(self, job):
+        """Return the features in the chunk files of job."""
+        result = []
+        for chunk in range(job.manifest['chunks']):
+            data = self._storage.read('exports/%s/pts-%05d.ndjson' %
+                                      (job.job_id, chunk))
+            result.extend(json.loads(line) for line in data.splitlines())
+        return result
+
+    def test_final_chunk_exactly_full(self):
+        job = export.ExportJob.create(self._storage, 'pts', chunk_size=3)
+        job.run(self._features)
+        manifest = json.loads(self._storage.read(
+                'exports/%s/manifest.json' % job.job_id))
+        self.assertEqual(export.DONE, manifest['state'])
+        self.assertEqual(3, manifest['chunks'])
+        self.assertEqual(9, manifest['features'])
+        self.assertEqual(9, manifest['last_key'])
+        self.assertEqual([_feature(i) for i in range(1, 10)],
+                         self.exported(job))
+        self.assertIsNone(self._storage.read(
+                'exports/%s/pts-00003.ndjson' % job.job_id))
+
+    def test_resume_after_error(self):
+        storage = FailingStorage(self._dir, 'pts-00001.ndjson')
+        job = export.ExportJob.create(storage, 'pts', chunk_size=4)
+        self.assertRaises(IOError, job.run, self._features)
+
+        job = export.ExportJob.load(self._storage, job.job_id)
+        self.assertEqual(export.ERROR, job.manifest['state'])
+        self.assertEqual('write failed', job.manifest['error'])
+        self.assertEqual(1, job.manifest['chunks'])
+        job.run(self._features)
+        self.assertEqual(export.DONE, job.manifest['state'])
+        self.assertIsNone(job.manifest['error'])
+        self.assertEqual([_feature(i) for i in range(1, 10)],
+                         self.exported(job))
+
+    def test_binary_format(self):
+        job = export.ExportJob.create(self._storage, 'pts',
+                                      fmt=export.BINARY, chunk_size=5)
+        job.run(self._features)
+        self.assertEqual(2, job.manifest['chunks'])
+        data = self._storage.read('exports/%s/pts-00001.bin' % job.job_id)
+        self.assertEqual(export.encode_binary(
+                [_feature(i) for i in range(6, 10)]), data)
+
+    def test_invalid_jobs(self):
+        self.assertRaises(ValueError, export.ExportJob.create,
+                          self._storage, 'pts', chunk_size=0)
+        self.assertRaises(ValueError, export.ExportJob.create,
+                          self._storage, 'pts', fmt='csv')
+        self.assertRaises(ValueError, export.ExportJob.load,
+                          self._storage, '../../etc')
+        self.assertIsNone(export.ExportJob.load(self._storage, '0' * 32))
+
+    def test_check(self):
+        export.ExportJob.create(self._storage, 'pts').check(self._features)
+        self.assertRaises(ValueError, export.ExportJob.create(
+                self._storage, 'pairs').check, self._features)
+        self.assertRaises(sqlalchemy.exc.NoSuchTableError,
+                          export.ExportJob.create(
+                                  self._storage, 'missing').check,
+                          self._features)
+
+
+if __name__ == '__main__':
+    unittest.main()
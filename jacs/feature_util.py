@@ -0,0 +1,38 @@
+# Copyright 2015 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Helpers for handling features that don't depend on App Engine."""
+
+
+def error_message(message, feature_id=None,index=None,status=400):
+    error = {'error': message, 'status': status}
+    if feature_id != None:
+        error["feature_id"] = feature_id
+    if index != None:
+        error["index"] = index
+    return error
+
+
+def verify_attributes(columns, attributes):
+    """ Makes sure all attributes are columns in the table
+
+    Args:
+        columns: list of columns to verify against
+        attributes: attributes to check
+    Returns:
+        None on success
+    """
+    for p in attributes:
+        if p not in columns:
+           raise ValueError("Invalid attribute: %s" % p)
+    return None
@@ -15,6 +15,7 @@
 import decimal
 import logging
 import json
+import threading
 
 import geojson
 import geomet.wkb
@@ -25,6 +26,9 @@ import sqlalchemy.exc
 import geometry_util
 import auth
 import types
+# error_message and verify_attributes are also used outside App Engine, so
+# they live in a module without App Engine imports.
+from feature_util import error_message, verify_attributes
 
 
 class Features(object):
@@ -43,12 +47,25 @@ class Features(object):
         self._geometry_field = geometry_field
         self._engine = engine
         self._metadata = sqlalchemy.MetaData()
+        self._tables = {}
+        self._lock = threading.Lock()
 
     def initialize_table(self, table):
-        return sqlalchemy.Table(
-                table, self._metadata,
-                sqlalchemy.Column(self._geometry_field, types.Geometry),
-                autoload=True, autoload_with=self._engine)
+        """Reflect table from the database, or return it if already reflected."""
+        # MetaData holds a table before it is reflected, so only tables that
+        # have been reflected completely are looked up without the lock.
+        tbl = self._tables.get(table)
+        if tbl is not None:
+            return tbl
+        with self._lock:
+            tbl = self._tables.get(table)
+            if tbl is None:
+                tbl = sqlalchemy.Table(
+                        table, self._metadata,
+                        sqlalchemy.Column(self._geometry_field, types.Geometry),
+                        autoload=True, autoload_with=self._engine)
+                self._tables[table] = tbl
+            return tbl
 
     def list(self, table, select, where,
              limit=None, offset=None, order_by=None, intersects=None):
@@ -72,9 +89,45 @@ class Features(object):
 
         if not auth.authorize("read", table):
             return error_message('Unauthorized', status=401)
-        features = []
-        cols = []
+        return self.query(table, select, where, limit=limit, offset=offset,
+                          order_by=order_by, intersects=intersects)
 
+    def query(self, table, select, where, limit=None, offset=None,
+              order_by=None, intersects=None, after=None):
+        """Query the database and return the result as GeoJSON.
+
+        This is list without the authorization check, for callers that have
+        already authorized the read, like export jobs.
+
+        Args:
+          See list.
+          after: Only return features with a primary key greater than this.
+              Only supported for tables with a single column primary key.
+
+        Returns:
+          A GeoJSON FeatureCollection representing the returned features, or
+              a dict explaining the error.
+        """
+        rows = self.query_rows(table, select, where, limit=limit,
+                               offset=offset, order_by=order_by,
+                               intersects=intersects, after=after)
+        if isinstance(rows, dict):
+            return rows
+        primary_key = get_primary_key(self.initialize_table(table))
+        # Return the list of features as a FeatureCollection.
+        return geojson.FeatureCollection(
+                [self.row_to_feature(row, primary_key) for row in rows])
+
+    def query_rows(self, table, select, where, limit=None, offset=None,
+                   order_by=None, intersects=None, after=None):
+        """Query the database and return the rows.
+
+        Args:
+          See query.
+
+        Returns:
+          A list of rows, or a dict explaining the error.
+        """
         tbl = self.initialize_table(table)
         primary_key = get_primary_key(tbl)
         select_list = []
@@ -106,11 +159,17 @@ class Features(object):
             where = '(%s)' % where
             query = query.where(sqlalchemy.text(where))
 
+        if after is not None:
+            if len(tbl.primary_key.columns) != 1:
+                return error_message(
+                        'Paging requires a single column primary key')
+            query = query.where(primary_key > after)
+
         if limit:
             query = query.limit(limit)
 
         if order_by:
-            query = query.order(order_by)
+            query = query.order_by(sqlalchemy.text(order_by))
 
         if offset:
             query = query.offset(offset)
@@ -118,39 +177,37 @@ class Features(object):
         # Connect and execute the query
         try:
             connection = self._engine.connect()
-            rows = connection.execute(query)
+            try:
+                return connection.execute(query).fetchall()
+            finally:
+                connection.close()
         except sqlalchemy.exc.SQLAlchemyError as e:
             # This error should probably be made better in a production system.
             return error_message('Something went wrong: {}'.format(e))
 
-        # now we read the rows and generate geojson out of them.
-        for row in rows:
-            wkbgeom = row[self._geometry_field]
-            props = {}
-            result_columns = row.items()
-            for column in result_columns:
-                if column[1] is not None and column[0] != self._geometry_field:
-                    if isinstance(column[1], decimal.Decimal):
-                        props[column[0]] = float(column[1])
-                    elif (isinstance(column[1], type('str')) or
-                          isinstance(column[1], type(u'unicode'))):
-                        props[column[0]] = column[1].encode('utf-8', 'ignore')
-                    else:
-                        props[column[0]] = str(column[1])
-
-            # geomet.wkb.loads returns a dict which corresponds to the geometry
-            # We dump this as a string, and let geojson parse it
-            geom = geojson.loads(json.dumps(geomet.wkb.loads(wkbgeom)))
-
-            feature_id = props[primary_key.name]
-
-            # Turn the geojson geometry into a proper GeoJSON feature
-            feature = geojson.Feature(geometry=geom, properties=props,
-                                      id=feature_id)
-            # Add the feature to our list of features.
-            features.append(feature)
-        # Return the list of features as a FeatureCollection.
-        return geojson.FeatureCollection(features)
+    def row_to_feature(self, row, primary_key):
+        """Turn a row returned by query_rows into a GeoJSON Feature."""
+        wkbgeom = row[self._geometry_field]
+        props = {}
+        result_columns = row.items()
+        for column in result_columns:
+            if column[1] is not None and column[0] != self._geometry_field:
+                if isinstance(column[1], decimal.Decimal):
+                    props[column[0]] = float(column[1])
+                elif (isinstance(column[1], type('str')) or
+                      isinstance(column[1], type(u'unicode'))):
+                    props[column[0]] = column[1].encode('utf-8', 'ignore')
+                else:
+                    props[column[0]] = str(column[1])
+
+        # geomet.wkb.loads returns a dict which corresponds to the geometry
+        # We dump this as a string, and let geojson parse it
+        geom = geojson.loads(json.dumps(geomet.wkb.loads(wkbgeom)))
+
+        feature_id = props[primary_key.name]
+
+        # Turn the geojson geometry into a proper GeoJSON feature
+        return geojson.Feature(geometry=geom, properties=props, id=feature_id)
 
     def create(self, table, features):
         """ Creates new records in table corresponding to the pass GeoJSON features.
@@ -311,29 +368,5 @@ def get_feature_id(primary_key, feature):
     return None
 
 
-def error_message(message, feature_id=None,index=None,status=400):
-    error = {'error': message, 'status': status}
-    if feature_id != None:
-        error["feature_id"] = feature_id
-    if index != None:
-        error["index"] = index
-    return error
-
-
-def verify_attributes(columns, attributes):
-    """ Makes sure all attributes are columns in the table
-
-    Args:
-        columns: list of columns to verify against
-        attributes: attributes to check
-    Returns:
-        None on success
-    """
-    for p in attributes:
-        if p not in columns:
-           raise ValueError("Invalid attribute: %s" % p)
-    return None
-
-
 class ST_Intersects(sqlalchemy.sql.functions.GenericFunction):
     type = sqlalchemy.types.Boolean
@@ -0,0 +1,36 @@
+# Copyright 2015 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Helpers for the tests."""
+
+from __future__ import absolute_import
+
+import sys
+import types
+
+
+def allow_appengine_imports():
+    """Make the users and oauth APIs importable without the App Engine SDK.
+
+    The modules are empty; tests replace what they use with fakes.
+    """
+    try:
+        from google.appengine.api import users, oauth
+    except ImportError:
+        for name in ('google', 'google.appengine', 'google.appengine.api'):
+            if name not in sys.modules:
+                sys.modules[name] = types.ModuleType(name)
+        for name in ('users', 'oauth'):
+            module = types.ModuleType('google.appengine.api.' + name)
+            sys.modules[module.__name__] = module
+            setattr(sys.modules['google.appengine.api'], name, module)
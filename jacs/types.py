@@ -10,3 +10,10 @@ class Geometry(UserDefinedType):
 
     def column_expression(self, col):
         return func.ST_AsWkb(col, type_=self)
+
+
+class WKBGeometry(Geometry):
+    """A Geometry that is bound as WKB rather than WKT."""
+
+    def bind_expression(self, bindvalue):
+        return func.ST_GeomFromWKB(bindvalue, type_=self)